@@ -1,6 +1,13 @@
 import asyncio
+import functools
+import heapq
+import html
 import logging
 import os
+import re
+import shutil
+import threading
+from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta, timezone
 import json
 import os.path
@@ -8,11 +15,26 @@ import os.path
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import Message
-from aiogram.utils.markdown import hbold
 from dotenv import load_dotenv
 
-from google_calendar import get_upcoming_events, create_auth_url, process_auth_code, get_credentials_with_local_server
+from google_calendar import get_upcoming_events, has_calendar_changes, create_auth_url, process_auth_code, get_credentials_with_local_server
 from database import Database
+from send_queue import SendQueue
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -25,6 +47,72 @@ logging.basicConfig(level=logging.INFO,
 bot = Bot(token=os.getenv("BOT_TOKEN"))
 dp = Dispatcher()
 
+# Очередь исходящих уведомлений с учетом лимитов Telegram
+send_queue = SendQueue(bot, workers=int(os.getenv('SEND_WORKERS') or 4))
+
+# Сколько хранятся записи о прошедших встречах
+EVENTS_RETENTION = timedelta(days=1)
+
+# Сколько пользователей проверяется одновременно в фоновой проверке
+MAX_CONCURRENT_USERS = int(os.getenv('MAX_CONCURRENT_USERS') or 8)
+
+# Шаблоны уведомлений: в них подставляются только данные встречи.
+# Название встречи перед подстановкой экранируется через escape_html, как это делал hbold
+_NEW_MEETING_TMPL = "📅 <b>Найдена новая онлайн-встреча:</b>\n\n📌 <b>{summary}</b>\n🕒 {start}\n🔗 {link}\n"
+_CHANGED_MEETING_TMPL = "🔄 <b>Изменение в онлайн-встрече:</b>\n\n📌 <b>{summary}</b>\n🕒 {start}\n🔗 {link}\n"
+_CANCELLED_MEETING_TMPL = "❌ <b>Онлайн-встреча отменена:</b>\n\n📌 <b>{summary}</b>\n🕒 {start}\n"
+_WEEK_DAY_TMPL = "📆 <b>Онлайн-встречи на {day}:</b>\n\n"
+_WEEK_MEETING_TMPL = "🕒 {time} - <b>{summary}</b>\n🔗 {link}\n\n"
+
+_SERVER_AUTH_TMPL = (
+    "📱 <b>Инструкция по авторизации на сервере:</b>\n\n"
+    "1️⃣ Перейдите по ссылке ниже в браузере:\n"
+    "{auth_url}\n\n"
+    "2️⃣ Войдите в аккаунт Google и разрешите доступ к календарю\n\n"
+    "3️⃣ Вы получите код авторизации. Скопируйте его\n\n"
+    "4️⃣ Отправьте боту команду:\n"
+    "/code ПОЛУЧЕННЫЙ_КОД\n\n"
+    "❗ Если возникает ошибка при авторизации, попробуйте использовать команду /manualtoken"
+)
+
+def escape_html(text):
+    """Экранирует текст для сообщений с parse_mode=HTML"""
+    return html.escape(text, quote=False)
+
+# Даты форматируются по полям datetime, без strftime и обращений к локали
+def _fmt_date(dt):
+    """Дата в виде ДД.ММ.ГГГГ"""
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year}"
+
+def _fmt_hm(dt):
+    """Время в виде ЧЧ:ММ"""
+    return f"{dt.hour:02d}:{dt.minute:02d}"
+
+def _fmt_dt(dt):
+    """Дата и время в виде ДД.ММ.ГГГГ ЧЧ:ММ"""
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year} {dt.hour:02d}:{dt.minute:02d}"
+
+# Внеплановый запуск фоновой проверки (например, сразу после авторизации нового пользователя)
+check_now = asyncio.Event()
+
+# Блокировки на пользователя: фоновая проверка и /check не должны одновременно
+# сверять и отмечать одни и те же встречи, иначе уведомление уйдет дважды
+_user_locks = {}
+
+def user_lock(user_id):
+    """Возвращает блокировку состояния встреч пользователя"""
+    key = str(user_id)
+    lock = _user_locks.get(key)
+    if lock is None:
+        lock = _user_locks[key] = asyncio.Lock()
+    return lock
+
+def prune_user_locks(active_users):
+    """Удаляет свободные блокировки пользователей, которых больше нет в базе"""
+    active = {str(user_id) for user_id in active_users}
+    for key in [k for k, lock in _user_locks.items() if k not in active and not lock.locked()]:
+        del _user_locks[key]
+
 # Директория для хранения токенов и данных
 DATA_DIR = os.getenv("DATA_DIR", ".")
 
@@ -40,15 +128,216 @@ try:
     with open(db_path, 'a'):
         pass
 except PermissionError:
-    logging.error(f"Нет прав на запись в файл базы данных: {db_path}")
+    logging.error("Нет прав на запись в файл базы данных: %s", db_path)
     # Пробуем изменить права
     try:
         os.chmod(db_path, 0o666)
     except Exception as e:
-        logging.error(f"Не удалось изменить права доступа к базе данных: {e}")
+        logging.error("Не удалось изменить права доступа к базе данных: %s", e)
 
 db = Database(db_path)
 
+def _read_text(path):
+    """Чтение файла целиком; для отсутствующего файла возвращает пустую строку"""
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'r') as f:
+        return f.read()
+
+def _json_loads(data):
+    """Разбор JSON из строки или байтов (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+@functools.lru_cache(maxsize=4)
+def _load_json(path, mtime_ns):
+    """Чтение JSON-файла; время изменения входит в ключ кэша, поэтому измененный файл читается заново"""
+    with open(path, 'rb') as f:
+        return _json_loads(f.read())
+
+@functools.lru_cache(maxsize=4)
+def _format_auth_info(path, mtime_ns):
+    """Собирает текст /authinfo по данным OAuth-клиента; пересобирается только после изменения файла"""
+    client_data = _load_json(path, mtime_ns)
+    client_info = client_data.get('installed', client_data.get('web', {}))
+    
+    return (
+        "📋 <b>Информация об OAuth-клиенте:</b>\n\n"
+        f"🔹 Тип клиента: {'Web' if 'web' in client_data else 'Desktop'}\n"
+        f"🔹 Client ID: {client_info.get('client_id', 'Не найден')[:15]}...\n"
+        f"🔹 Redirect URIs: {', '.join(client_info.get('redirect_uris', ['Не найдены']))}\n\n"
+        "Для корректной работы авторизации убедитесь, что:\n"
+        "1. В Google Cloud Console включен Calendar API\n"
+        "2. Настроен OAuth consent screen\n"
+        "3. Добавлен ваш email в список тестовых пользователей\n"
+        "4. В redirect URIs добавлен urn:ietf:wg:oauth:2.0:oob"
+    )
+
+def _auth_info(path):
+    """Текст /authinfo для текущей версии файла с данными клиента"""
+    return _format_auth_info(path, os.stat(path).st_mtime_ns)
+
+def _atomic_write(path, data):
+    """Атомарная запись файла: данные пишутся во временный файл, который затем заменяет исходный"""
+def _atomic_write(path, data):
+    """Атомарная запись файла: данные пишутся во временный файл, который затем заменяет исходный"""
+    # Если файл - символическая ссылка, заменяем файл, на который она указывает, а не саму ссылку
+    path = os.path.realpath(path)
+    # Имя временного файла уникально для процесса и потока, чтобы параллельные записи не мешали друг другу
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        # Временный файл сразу доступен только владельцу: в .env лежит токен бота
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Новый файл получает права исходного, а не права по umask
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Не оставляем недописанный временный файл рядом с исходным
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# USER_ID, записанный в .env, и время изменения файла, для которого он прочитан
+_env_cache = {'mtime': None, 'user_id': None}
+_USER_ID_RE = re.compile(r'^USER_ID=(.*)$', re.M)
+
+def _env_mtime(path):
+    """Время изменения файла или None, если файла нет"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _stored_user_id(path):
+    """Возвращает USER_ID из .env, перечитывая файл только после его изменения"""
+    mtime = _env_mtime(path)
+    if mtime != _env_cache['mtime']:
+        match = _USER_ID_RE.search(_read_text(path))
+        _env_cache['user_id'] = match.group(1).strip() if match else None
+        _env_cache['mtime'] = mtime
+    return _env_cache['user_id']
+
+def _persist_user_id(path, user_id):
+    """Обновляет или добавляет USER_ID в .env, если там записан другой пользователь"""
+    user_id = str(user_id)
+    if _stored_user_id(path) == user_id:
+        return
+    
+    text, found = _USER_ID_RE.subn(f'USER_ID={user_id}', _read_text(path), count=1)
+    if not found:
+        if text and not text.endswith('\n'):
+            text += '\n'
+        text += f'USER_ID={user_id}\n'
+    _atomic_write(path, text.encode())
+    _env_cache['user_id'] = user_id
+    _env_cache['mtime'] = _env_mtime(path)
+
+# .env записывает фоновая задача: обработчик не ждет диска,
+# а несколько обновлений подряд сливаются в одну запись
+_env_write_queue = asyncio.Queue()
+
+def remember_user_id(user_id):
+    """Запоминает последнего авторизованного пользователя и ставит сохранение его ID в .env в очередь"""
+    global USER_ID
+    USER_ID = str(user_id)
+    _env_write_queue.put_nowait(USER_ID)
+
+async def env_writer():
+    """Сохраняет в .env последний USER_ID из очереди"""
+    while True:
+        user_id = await _env_write_queue.get()
+        # Если обновлений накопилось несколько, записывать нужно только последнее
+        while not _env_write_queue.empty():
+            user_id = _env_write_queue.get_nowait()
+        try:
+            await asyncio.to_thread(_persist_user_id, '.env', user_id)
+        except Exception as e:
+            logging.error("Ошибка при сохранении USER_ID в .env: %s", e)
+
+# Кэш ответов Google Calendar: повторный запрос того же окна в течение
+# EVENTS_CACHE_TTL секунд (например, /week сразу после /check) не идет в API.
+# Позже, но не дольше FULL_SYNC_INTERVAL секунд после полной загрузки, ответ используется повторно,
+# если короткий запрос с updatedMin показывает, что в календаре ничего не менялось
+EVENTS_CACHE_TTL = 60
+FULL_SYNC_INTERVAL = 3600
+EVENTS_CACHE_SIZE = 128
+# Ключ -> (время удаления, время до которого ответ используется без проверки, события,
+# момент (UTC), начиная с которого нужно проверять изменения)
+_events_cache = {}
+# Куча (время удаления, ключ) для удаления устаревших записей без обхода всего кэша
+_events_expiry = []
+
+async def cached_events(user_id, time_min, time_max, limit=10):
+    """Получает события из календаря через кэш, проверяя изменения перед повторным использованием"""
+    loop = asyncio.get_running_loop()
+    # Границы окна округляются до минуты, чтобы ключ не менялся между соседними вызовами
+    key = (
+        str(user_id),
+        time_min.replace(second=0, microsecond=0),
+        time_max.replace(second=0, microsecond=0),
+        limit
+    )
+    cached = _events_cache.get(key)
+    if cached and loop.time() < cached[0]:
+        drop_at, fresh_until, events, synced_at = cached
+        if loop.time() < fresh_until:
+            return events
+        # Момент фиксируется до запроса: изменения, сделанные во время него, попадут в следующую проверку
+        requested_at = datetime.now(timezone.utc)
+        try:
+            changed = await has_calendar_changes(user_id, db, synced_at)
+        except Exception as e:
+            # Например, 410 Gone - тогда просто загружаем окно целиком
+            logging.warning("Не удалось проверить изменения календаря пользователя %s: %s", user_id, e)
+            changed = True
+        # Пока шла проверка, запись могла быть сброшена (например, после смены токена)
+        if not changed and _events_cache.get(key) is cached:
+            logging.info("Календарь пользователя %s не изменился, используем ранее полученные события", user_id)
+            _events_cache[key] = (drop_at, loop.time() + EVENTS_CACHE_TTL, events, requested_at)
+            return events
+    
+    requested_at = datetime.now(timezone.utc)
+    events = await get_upcoming_events(
+        limit=limit,
+        time_min=time_min,
+        time_max=time_max,
+        user_id=user_id,
+        db=db
+    )
+    
+    now = loop.time()
+    # Удаляем истекшие записи, а при переполнении - те, что истекут раньше остальных
+    while _events_expiry and (_events_expiry[0][0] <= now or len(_events_cache) >= EVENTS_CACHE_SIZE):
+        expires_at, expired_key = heapq.heappop(_events_expiry)
+        # Запись могла быть обновлена позже, тогда в куче лежит ее более старая копия
+        cached = _events_cache.get(expired_key)
+        if cached and cached[0] == expires_at:
+            del _events_cache[expired_key]
+    
+    # После полной загрузки ответ можно проверять через updatedMin не дольше FULL_SYNC_INTERVAL
+    drop_at = now + FULL_SYNC_INTERVAL
+    _events_cache[key] = (drop_at, now + EVENTS_CACHE_TTL, events, requested_at)
+    heapq.heappush(_events_expiry, (drop_at, key))
+    return events
+
+def invalidate_events_cache(user_id=None):
+    """Сбрасывает кэш событий календаря пользователя (всех пользователей, если user_id не указан)"""
+    if user_id is None:
+        _events_cache.clear()
+        _events_expiry.clear()
+        return
+    # Записи в куче остаются, но при извлечении они уже не найдутся в кэше
+    user_id = str(user_id)
+    for key in [key for key in _events_cache if key[0] == user_id]:
+        del _events_cache[key]
+
 # Команда /start
 @dp.message(Command("start"))
 async def command_start(message: Message):
@@ -64,7 +353,7 @@ async def command_start(message: Message):
         "3. Ручной ввод токена (для продвинутых пользователей): /manualtoken"
     )
     
-    logging.info(f"Команда /start от пользователя ID: {user_id}, имя: {message.from_user.full_name}")
+    logging.info("Команда /start от пользователя ID: %s, имя: %s", user_id, message.from_user.full_name)
 
 # Команда /week для просмотра встреч на неделю
 @dp.message(Command("week"))
@@ -72,7 +361,7 @@ async def check_week_meetings(message: Message):
     user_id = message.from_user.id
     
     # Проверяем наличие токена в базе данных
-    if not db.get_token(user_id):
+    if not await asyncio.to_thread(db.get_token, user_id):
         await message.answer(
             "Вы не авторизованы в Google Calendar.\n"
             "Используйте команду /serverauth для авторизации."
@@ -83,8 +372,8 @@ async def check_week_meetings(message: Message):
     
     try:
         # Получаем события на ближайшие 7 дней
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         now = datetime.now(timezone.utc)
+        today = now.astimezone().replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
         
         # Определяем начало недели
         current_weekday = today.weekday()
@@ -93,61 +382,52 @@ async def check_week_meetings(message: Message):
         else:
             week_start = today - timedelta(days=current_weekday)
             
-        events = await get_upcoming_events(
+        events = await cached_events(
+            user_id,
             time_min=week_start,
             time_max=week_start + timedelta(days=6),
-            limit=20,
-            user_id=user_id,
-            db=db
+            limit=20
         )
         
-        # Фильтруем события
-        active_events = []
-        for event in events:
-            # Пропускаем события без ссылки на подключение
-            if 'hangoutLink' not in event:
-                continue
-                
-            end_time = event['end'].get('dateTime', event['end'].get('date'))
-            end_dt = safe_parse_datetime(end_time)
-            if end_dt > now:
-                active_events.append(event)
+        # Оставляем незавершенные встречи со ссылкой на подключение
+        parse = safe_parse_datetime
+        active_events = [
+            event for event in events
+            if 'hangoutLink' in event
+            and parse(event['end'].get('dateTime') or event['end'].get('date')) > now
+        ]
         
         if not active_events:
             await message.answer("У вас нет предстоящих онлайн-встреч на неделю.")
             return
         
         # Группируем встречи по дням
-        meetings_by_day = {}
+        # Ключ - дата, а не строка: строки вида дд.мм.гггг сортируются не по времени
+        meetings_by_day = defaultdict(list)
         for event in active_events:
-            start_time = event['start'].get('dateTime', event['start'].get('date'))
-            start_dt = safe_parse_datetime(start_time)
-            day_key = start_dt.strftime('%d.%m.%Y')
-            
-            if day_key not in meetings_by_day:
-                meetings_by_day[day_key] = []
-            
-            meetings_by_day[day_key].append(event)
+            start = event['start']
+            start_dt = safe_parse_datetime(start.get('dateTime') or start.get('date'))
+            meetings_by_day[start_dt.date()].append((start_dt, event))
         
         # Отправляем встречи по дням
         for day, day_events in sorted(meetings_by_day.items()):
-            day_message = f"📆 {hbold(f'Онлайн-встречи на {day}:')}\n\n"
+            parts = [_WEEK_DAY_TMPL.format(day=_fmt_date(day))]
             has_meetings = False
             
-            for event in day_events:
-                start_time = event['start'].get('dateTime', event['start'].get('date'))
-                start_dt = safe_parse_datetime(start_time)
-                
-                day_message += f"🕒 {start_dt.strftime('%H:%M')} - {hbold(event['summary'])}\n"
-                day_message += f"🔗 {event['hangoutLink']}\n\n"
+            for start_dt, event in day_events:
+                parts.append(_WEEK_MEETING_TMPL.format(
+                    time=_fmt_hm(start_dt),
+                    summary=escape_html(event['summary']),
+                    link=event['hangoutLink']
+                ))
                 has_meetings = True
             
             # Отправляем сообщение если есть встречи
             if has_meetings:
-                await message.answer(day_message, parse_mode="HTML")
+                await send_queue.send(message.chat.id, ''.join(parts), parse_mode="HTML")
     
     except Exception as e:
-        logging.error(f"Ошибка при получении встреч на неделю: {e}")
+        logging.error("Ошибка при получении встреч на неделю: %s", e)
         await message.answer("Произошла ошибка при получении данных о встречах.")
 
 # Команда /reset для сброса кэша обработанных встреч
@@ -155,122 +435,186 @@ async def check_week_meetings(message: Message):
 async def reset_processed_events(message: Message):
     try:
         # Сбрасываем все данные в базе
-        db.reset_all()
+        await asyncio.to_thread(db.reset_all)
+        invalidate_events_cache()
         await message.answer("✅ Все данные успешно сброшены. Теперь вы получите уведомления о всех текущих встречах как о новых.")
     except Exception as e:
-        logging.error(f"Ошибка при сбросе данных: {e}")
+        logging.error("Ошибка при сбросе данных: %s", e)
         await message.answer("❌ Произошла ошибка при сбросе данных.")
 
+# Разбор даты с кэшированием: одни и те же строки приходят из календаря каждый цикл.
+# Ошибки не кэшируются, их обрабатывает safe_parse_datetime
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(date_str):
+    if ciso8601 is not None:
+        # Разбор на C: понимает и дату без времени, и суффикс Z
+        dt = ciso8601.parse_datetime(date_str)
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    # Календарь отдает даты в трех видах: YYYY-MM-DD (весь день), ...Z и ...±HH:MM
+    if len(date_str) == 10:
+        return datetime(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]), tzinfo=timezone.utc)
+    if date_str[-1] == 'Z':
+        return datetime.fromisoformat(date_str[:-1]).replace(tzinfo=timezone.utc)
+    dt = datetime.fromisoformat(date_str)
+    # Если дата без часового пояса, добавляем UTC
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
 # Функция для безопасного парсинга даты
 def safe_parse_datetime(date_str):
     try:
-        if date_str.endswith('Z'):
-            return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        elif '+' in date_str or '-' in date_str and 'T' in date_str:
-            return datetime.fromisoformat(date_str)
-        else:
-            # Если дата без часового пояса, добавляем UTC
-            return datetime.fromisoformat(date_str).replace(tzinfo=timezone.utc)
+        return _parse_datetime(date_str)
     except Exception as e:
-        logging.error(f"Ошибка при парсинге даты {date_str}: {e}")
+        logging.error("Ошибка при парсинге даты %s: %s", date_str, e)
         return datetime.now(timezone.utc)
 
-async def get_upcoming_meetings(user_id):
-    """Получает предстоящие встречи для конкретного пользователя."""
+def utc_isoformat(date_str):
+    """Время из календаря в UTC в формате ISO: такие строки можно сравнивать между собой, в том числе в SQL"""
+    if date_str is None:
+        return None
+    return safe_parse_datetime(date_str).astimezone(timezone.utc).isoformat()
+
+# Встреча из календаря: поля разобраны один раз при получении событий.
+# end_time хранится в UTC: по нему из базы удаляются закончившиеся встречи
+Meeting = namedtuple('Meeting', 'event_id summary hangout_link start_time start_dt end_time')
+
+async def get_upcoming_meetings(user_id, today):
+    """Получает предстоящие встречи для конкретного пользователя начиная с дня today."""
     meetings = set()
     try:
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        events = await get_upcoming_events(
+        events = await cached_events(
+            user_id,
             time_min=today,
-            time_max=today + timedelta(days=6),
-            user_id=user_id,
-            db=db
+            time_max=today + timedelta(days=6)
         )
         
         for event in events:
-            if 'hangoutLink' in event:
-                meetings.add((event['id'], event['summary'], event['hangoutLink'], event['start'].get('dateTime', event['start'].get('date'))))
+            hangout_link = event.get('hangoutLink')
+            if hangout_link:
+                start, end = event['start'], event['end']
+                start_time = start.get('dateTime') or start.get('date')
+                # Время начала разбирается один раз здесь и дальше передается в виде datetime
+                meetings.add(Meeting(
+                    event['id'], event['summary'], hangout_link, start_time, safe_parse_datetime(start_time),
+                    utc_isoformat(end.get('dateTime') or end.get('date'))
+                ))
     except Exception as e:
-        logging.error(f"Ошибка при получении встреч для пользователя {user_id}: {e}")
+        logging.error("Ошибка при получении встреч для пользователя %s: %s", user_id, e)
     
     return meetings
 
 async def notify_about_meeting(meeting, user_id):
-    """Отправляет уведомление о новой встрече конкретному пользователю."""
-    event_id, summary, hangout_link, start_time = meeting
+    """Отправляет уведомление о новой встрече и ждет доставки. Отметку в базе делает вызывающий код"""
+    event_id, summary, hangout_link, start_time, start_dt, end_time = meeting
     try:
-        # Проверяем, было ли уже отправлено уведомление
-        if not db.is_notification_sent(event_id, user_id):
-            start_dt = safe_parse_datetime(start_time)
-            meeting_info = (
-                f"📅 {hbold('Найдена новая онлайн-встреча:')}\n\n"
-                f"📌 {hbold(summary)}\n"
-                f"🕒 {start_dt.strftime('%d.%m.%Y %H:%M')}\n"
-                f"🔗 {hangout_link}\n"
-            )
-            await bot.send_message(
-                user_id,
-                meeting_info,
-                parse_mode="HTML"
-            )
-            # Помечаем встречу как известную и уведомление как отправленное
-            db.add_known_event(event_id, summary, start_time, None, user_id, notification_sent=True)
-            logging.info(f"Отправлено уведомление пользователю {user_id} о встрече {summary}")
+        meeting_info = _NEW_MEETING_TMPL.format(
+            summary=escape_html(summary),
+            start=_fmt_dt(start_dt),
+            link=hangout_link
+        )
+        delivered = await send_queue.send(user_id, meeting_info, parse_mode="HTML")
+        # Встреча отмечается в базе только после того, как Telegram принял сообщение
+        if not await delivered:
+            return False
+        logging.info("Отправлено уведомление пользователю %s о встрече %s", user_id, summary)
+        return True
     except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+        logging.error("Ошибка при отправке уведомления пользователю %s: %s", user_id, e)
+        return False
 
 async def scheduled_meetings_check():
     """Периодическая проверка новых встреч для всех пользователей"""
     user_first_run = {}  # Словарь для отслеживания первого запуска для каждого пользователя
     
+    # Проверки идут по фиксированному расписанию от монотонных часов,
+    # поэтому время самой проверки не сдвигает следующий запуск
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_USERS)
+    
     while True:
+        # Запросы на внеплановую проверку, пришедшие до этого момента, обслужит текущий цикл
+        check_now.clear()
         try:
-            users = db.get_all_users()
-            logging.info(f"Проверка встреч для {len(users)} пользователей")
+            users = await asyncio.to_thread(db.get_all_users)
+            logging.info("Проверка встреч для %d пользователей", len(users))
+            
+            # Время фиксируется один раз на цикл и общее для всех пользователей
+            now_utc = datetime.now(timezone.utc)
+            today = now_utc.astimezone().replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+            
+            async def check_user(user_id):
+                async with semaphore:
+                    # Получаем текущие встречи для пользователя
+                    current_meetings = await get_upcoming_meetings(user_id, today)
+                
+                async with user_lock(user_id):
+                    if not user_first_run[user_id]:
+                        # Один запрос на пользователя вместо запроса на каждую встречу
+                        notified_ids = await asyncio.to_thread(db.get_notified_event_ids, user_id)
+                        # Новые встречи: о них еще не было уведомления
+                        new_meetings = [meeting for meeting in current_meetings if meeting.event_id not in notified_ids]
+                        # Уведомления ставятся в очередь сразу все, а в базе одной транзакцией
+                        # отмечаются только те, доставку которых подтвердил Telegram
+                        delivered = await asyncio.gather(*(notify_about_meeting(meeting, user_id) for meeting in new_meetings))
+                        notified = [
+                            (meeting.event_id, meeting.summary, meeting.start_time, meeting.end_time)
+                            for meeting, ok in zip(new_meetings, delivered) if ok
+                        ]
+                        if notified:
+                            await asyncio.to_thread(db.add_known_events, notified, user_id, notification_sent=True)
+                    else:
+                        # При первом запуске добавляем все текущие встречи как известные одной транзакцией
+                        await asyncio.to_thread(
+                            db.add_known_events,
+                            [(meeting.event_id, meeting.summary, meeting.start_time, meeting.end_time) for meeting in current_meetings],
+                            user_id,
+                            notification_sent=True
+                        )
+                        user_first_run[user_id] = False
+                        logging.info("Первый запуск завершен для пользователя %s, добавлено %d встреч", user_id, len(current_meetings))
             
             for user_id in users:
                 # Инициализируем first_run для нового пользователя
                 if user_id not in user_first_run:
                     user_first_run[user_id] = True
-                    logging.info(f"Первый запуск для пользователя {user_id}")
-                
-                # Получаем текущие встречи для пользователя
-                current_meetings = await get_upcoming_meetings(user_id)
-                
-                if not user_first_run[user_id]:
-                    # Проверяем каждую встречу отдельно
-                    for meeting in current_meetings:
-                        event_id, summary, hangout_link, start_time = meeting
-                        
-                        # Проверяем, было ли уже отправлено уведомление
-                        if not db.is_notification_sent(event_id, user_id):
-                            await notify_about_meeting(meeting, user_id)
-                        
-                else:
-                    # При первом запуске добавляем все текущие встречи как известные
-                    for meeting in current_meetings:
-                        event_id, summary, _, _ = meeting
-                        db.add_known_event(event_id, summary, None, None, user_id, notification_sent=True)
-                    user_first_run[user_id] = False
-                    logging.info(f"Первый запуск завершен для пользователя {user_id}, добавлено {len(current_meetings)} встреч")
+                    logging.info("Первый запуск для пользователя %s", user_id)
+            
+            # Пользователи проверяются параллельно, но не более MAX_CONCURRENT_USERS запросов к API одновременно
+            results = await asyncio.gather(*(check_user(user_id) for user_id in users), return_exceptions=True)
+            for user_id, result in zip(users, results):
+                if isinstance(result, Exception):
+                    logging.error("Ошибка при проверке встреч пользователя %s: %s", user_id, result)
             
             # Очистка словаря first_run от пользователей, которых больше нет в базе
-            for user_id in list(user_first_run.keys()):
-                if user_id not in users:
-                    del user_first_run[user_id]
+            current_users = set(users)
+            user_first_run = {k: v for k, v in user_first_run.items() if k in current_users}
+            prune_user_locks(current_users)
             
-            await asyncio.sleep(int(os.getenv('CHECK_INTERVAL', 300)))
+            # Удаляем записи о закончившихся встречах, чтобы таблицы не росли бесконечно
+            await asyncio.to_thread(db.clean_old_events, now_utc - EVENTS_RETENTION)
         except Exception as e:
-            logging.error(f"Ошибка при проверке встреч: {e}")
-            await asyncio.sleep(int(os.getenv('CHECK_INTERVAL', 300)))
+            logging.error("Ошибка при проверке встреч: %s", e)
+        
+        next_tick += int(os.getenv('CHECK_INTERVAL', 300))
+        now = loop.time()
+        if next_tick < now:
+            # Проверка заняла больше интервала: не догоняем пропущенные запуски
+            next_tick = now
+        try:
+            # Ждем следующей проверки по расписанию или внепланового запуска
+            await asyncio.wait_for(check_now.wait(), next_tick - now)
+            # Расписание продолжается от момента внеплановой проверки
+            next_tick = loop.time()
+        except asyncio.TimeoutError:
+            pass
 
 # Команда /auth для авторизации в Google Calendar
 @dp.message(Command("auth"))
 async def auth_command(message: Message):
     user_id = message.from_user.id
     
-    # Создаем URL для авторизации
-    auth_url = create_auth_url(user_id, db)
+    # Создаем URL для авторизации (чтение credentials.json и запись состояния в базу - в отдельном потоке)
+    auth_url = await asyncio.to_thread(create_auth_url, user_id, db)
     
     await message.answer(
         f"Для авторизации в Google Calendar, пожалуйста, перейдите по ссылке:\n\n"
@@ -304,34 +648,14 @@ async def process_auth_code_command(message: Message):
         await processing_msg.edit_text(result)
         
         if success:
-            # Если авторизация успешна, обновляем USER_ID
-            global USER_ID
-            USER_ID = str(user_id)
-            
-            # Сохраняем USER_ID в .env файл
-            env_path = '.env'
-            env_lines = []
-            
-            if os.path.exists(env_path):
-                with open(env_path, 'r') as f:
-                    env_lines = f.readlines()
-            
-            # Обновляем или добавляем USER_ID
-            user_id_found = False
-            for i, line in enumerate(env_lines):
-                if line.startswith('USER_ID='):
-                    env_lines[i] = f'USER_ID={user_id}\n'
-                    user_id_found = True
-                    break
-            
-            if not user_id_found:
-                env_lines.append(f'USER_ID={user_id}\n')
-            
-            # Записываем обновленный .env файл
-            with open(env_path, 'w') as f:
-                f.writelines(env_lines)
+            # События, полученные по прежнему токену, больше не актуальны
+            invalidate_events_cache(user_id)
+            # Если авторизация успешна, обновляем USER_ID и сохраняем его в .env
+            remember_user_id(user_id)
+            # Сразу включаем пользователя в фоновую проверку
+            check_now.set()
     except Exception as e:
-        logging.error(f"Ошибка при обработке кода авторизации: {e}")
+        logging.error("Ошибка при обработке кода авторизации: %s", e)
         await processing_msg.edit_text(f"❌ Произошла ошибка: {str(e)}")
 
 # Команда /check для принудительной проверки новых встреч
@@ -340,7 +664,7 @@ async def check_command(message: Message):
     user_id = message.from_user.id
     
     # Проверяем авторизацию
-    if not db.get_token(user_id):
+    if not await asyncio.to_thread(db.get_token, user_id):
         await message.answer(
             "Вы не авторизованы в Google Calendar.\n"
             "Используйте команду /serverauth для авторизации."
@@ -349,111 +673,108 @@ async def check_command(message: Message):
     
     try:
         # Получаем события
-        events = await get_upcoming_events(
-            time_min=datetime.now(), 
-            time_max=datetime.now() + timedelta(days=7),
-            limit=10,
-            user_id=user_id,
-            db=db
+        now = datetime.now()
+        events = await cached_events(
+            user_id,
+            time_min=now, 
+            time_max=now + timedelta(days=7),
+            limit=10
         )
         
-        # Получаем все известные события
-        known_events = db.get_known_events(user_id)
-        current_event_ids = set()
-        new_events_count = 0
-        deleted_events_count = 0
-        changed_events_count = 0
-        
-        # Проверяем новые и измененные встречи
-        for event in events:
-            # Пропускаем события без ссылки на подключение
-            if 'hangoutLink' not in event:
-                continue
-                
-            event_id = event['id']
-            current_event_ids.add(event_id)
-            
-            # Получаем время начала и окончания встречи
-            start_time = event['start'].get('dateTime', event['start'].get('date'))
-            end_time = event['end'].get('dateTime', event['end'].get('date'))
-            start_dt = safe_parse_datetime(start_time)
-            
-            # Проверяем, было ли уже отправлено уведомление
-            notification_sent = db.is_notification_sent(event_id, user_id)
-            logging.info(f"Проверка встречи {event['summary']} (ID: {event_id}): notification_sent = {notification_sent}")
-            
-            # Если встреча новая или о ней не было уведомления
-            if not db.is_event_known(event_id, user_id) or not notification_sent:
-                new_events_count += 1
-                
-                meeting_info = (
-                    f"📅 {hbold('Найдена новая онлайн-встреча:')}\n\n"
-                    f"📌 {hbold(event['summary'])}\n"
-                    f"🕒 {start_dt.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"🔗 {event['hangoutLink']}\n"
-                )
-                
-                await message.answer(meeting_info, parse_mode="HTML")
-                
-                # Сохраняем в базу данных как обработанное и помечаем уведомление как отправленное
-                db.add_known_event(
-                    event_id=event_id,
-                    summary=event['summary'],
-                    start_time=start_time,
-                    end_time=end_time,
-                    user_id=user_id,
-                    notification_sent=True  # Важно: помечаем как отправленное
-                )
-                
-                # Проверяем, что флаг действительно установлен
-                if not db.is_notification_sent(event_id, user_id):
-                    logging.error(f"Ошибка: флаг notification_sent не был установлен для встречи {event_id}")
-                else:
-                    logging.info(f"Отправлено уведомление через /check пользователю {user_id} о встрече {event['summary']}")
-            else:
+        # Сверка с базой и отметки об уведомлениях выполняются атомарно для пользователя
+        async with user_lock(user_id):
+            # Получаем все известные события, индексируя их по ID
+            known_events = await asyncio.to_thread(db.get_known_events_map, user_id)
+            notified_ids = await asyncio.to_thread(db.get_notified_event_ids, user_id)
+            current_event_ids = set()
+            # Изменения в базе копятся и записываются одной транзакцией после сверки
+            upserts = []
+            # Изменения, о которых отправлено сообщение: в базу они попадают только после доставки,
+            # иначе при следующей проверке о них сообщат снова
+            sent_upserts = []
+            sent_deletes = []
+            new_events_count = 0
+            deleted_events_count = 0
+            changed_events_count = 0
+
+            # Проверяем новые и измененные встречи
+            for event in events:
+                # Пропускаем события без ссылки на подключение
+                hangout_link = event.get('hangoutLink')
+                if not hangout_link:
+                    continue
+
+                event_id = event['id']
+                current_event_ids.add(event_id)
+
+                # Получаем время начала и окончания встречи
+                start, end = event['start'], event['end']
+                start_time = start.get('dateTime') or start.get('date')
+                end_time = utc_isoformat(end.get('dateTime') or end.get('date'))
+                start_dt = safe_parse_datetime(start_time)
+
+                # Проверяем, было ли уже отправлено уведомление
+                notification_sent = event_id in notified_ids
+                logging.info("Проверка встречи %s (ID: %s): notification_sent = %s", event['summary'], event_id, notification_sent)
+
+                # Если встреча новая или о ней не было уведомления
+                if event_id not in known_events or not notification_sent:
+                    new_events_count += 1
+
+                    meeting_info = _NEW_MEETING_TMPL.format(
+                        summary=escape_html(event['summary']),
+                        start=_fmt_dt(start_dt),
+                        link=hangout_link
+                    )
+
+                    delivered = await send_queue.send(message.chat.id, meeting_info, parse_mode="HTML")
+                    sent_upserts.append((delivered, (event_id, event['summary'], start_time, end_time)))
+                    continue
+
                 # Если встреча уже известна, проверяем изменения
-                known_event = next((e for e in known_events if e['event_id'] == event_id), None)
-                if known_event and (known_event['start_time'] != start_time or known_event['end_time'] != end_time):
+                _, known_start, known_end = known_events[event_id]
+                # Время окончания сравнивается в UTC: старые записи хранят его в исходном виде или не хранят вовсе
+                if known_start != start_time or (known_end is not None and utc_isoformat(known_end) != end_time):
                     changed_events_count += 1
-                    change_info = (
-                        f"🔄 {hbold('Изменение в онлайн-встрече:')}\n\n"
-                        f"📌 {hbold(event['summary'])}\n"
-                        f"🕒 {start_dt.strftime('%d.%m.%Y %H:%M')}\n"
-                        f"🔗 {event['hangoutLink']}\n"
+                    change_info = _CHANGED_MEETING_TMPL.format(
+                        summary=escape_html(event['summary']),
+                        start=_fmt_dt(start_dt),
+                        link=hangout_link
                     )
-                    await message.answer(change_info, parse_mode="HTML")
-                
-                # Обновляем данные встречи
-                db.add_known_event(
-                    event_id=event_id,
-                    summary=event['summary'],
-                    start_time=start_time,
-                    end_time=end_time,
-                    user_id=user_id,
-                    notification_sent=True  # Обновляем флаг на всякий случай
-                )
-        
-        # Проверяем удаленные события
-        for known_event in known_events:
-            if known_event['event_id'] not in current_event_ids:
+                    delivered = await send_queue.send(message.chat.id, change_info, parse_mode="HTML")
+                    sent_upserts.append((delivered, (event_id, event['summary'], start_time, end_time)))
+                    continue
+
+                # Сохраняем данные встречи и помечаем уведомление как отправленное
+                upserts.append((event_id, event['summary'], start_time, end_time))
+
+            # Проверяем удаленные события
+            for event_id in known_events.keys() - current_event_ids:
+                summary, known_start, _ = known_events[event_id]
                 deleted_events_count += 1
-                
-                deleted_meeting_info = (
-                    f"❌ {hbold('Онлайн-встреча отменена:')}\n\n"
-                    f"📌 {hbold(known_event['summary'])}\n"
-                    f"🕒 {safe_parse_datetime(known_event['start_time']).strftime('%d.%m.%Y %H:%M')}\n"
+
+                deleted_meeting_info = _CANCELLED_MEETING_TMPL.format(
+                    summary=escape_html(summary),
+                    start=_fmt_dt(safe_parse_datetime(known_start))
                 )
-                
-                await message.answer(deleted_meeting_info, parse_mode="HTML")
-                
-                # Удаляем событие из базы
-                db.delete_known_event(known_event['event_id'], user_id)
+
+                delivered = await send_queue.send(message.chat.id, deleted_meeting_info, parse_mode="HTML")
+                sent_deletes.append((delivered, event_id))
+
+            for delivered, event in sent_upserts:
+                if await delivered:
+                    upserts.append(event)
+                    logging.info("Отправлено уведомление через /check пользователю %s о встрече %s", user_id, event[1])
+            deleted_ids = [event_id for delivered, event_id in sent_deletes if await delivered]
+
+            # Сохраняем актуальные встречи и удаляем отмененные одной транзакцией
+            await asyncio.to_thread(db.update_known_events, upserts, deleted_ids, user_id)
         
         if new_events_count == 0 and deleted_events_count == 0 and changed_events_count == 0:
             await message.answer("Изменений в расписании онлайн-встреч не найдено.")
             
     except Exception as e:
-        logging.error(f"Ошибка при проверке встреч: {e}")
+        logging.error("Ошибка при проверке встреч: %s", e)
         await message.answer(f"❌ Произошла ошибка: {str(e)}")
 
 # Команда /localauth для авторизации через локальный сервер
@@ -469,7 +790,8 @@ async def local_auth_command(message: Message):
         
         if creds:
             # Сохраняем токен в базу данных
-            db.save_token(user_id, json.loads(creds.to_json()))
+            await asyncio.to_thread(db.save_token, user_id, creds.to_json())
+            invalidate_events_cache(user_id)
             
             await message.answer(
                 "✅ Авторизация успешно завершена!\n\n"
@@ -478,16 +800,17 @@ async def local_auth_command(message: Message):
                 "/week - показать встречи на неделю"
             )
             
-            # Обновляем USER_ID
-            global USER_ID
-            USER_ID = str(user_id)
+            # Обновляем USER_ID и сохраняем его в .env
+            remember_user_id(user_id)
+            # Сразу включаем пользователя в фоновую проверку
+            check_now.set()
         else:
             await message.answer(
                 "❌ Не удалось получить учетные данные.\n"
                 "Попробуйте другой способ авторизации: /serverauth"
             )
     except Exception as e:
-        logging.error(f"Ошибка при локальной авторизации: {e}")
+        logging.error("Ошибка при локальной авторизации: %s", e)
         await message.answer(
             f"❌ Произошла ошибка при авторизации: {str(e)}\n"
             "Попробуйте другой способ авторизации: /serverauth"
@@ -515,20 +838,34 @@ async def set_token_command(message: Message):
     
     token_json = parts[1].strip()
     
+    # Без этих полей токен будет отклонен, поэтому такие данные даже не разбираем
+    if '"token"' not in token_json or '"refresh_token"' not in token_json:
+        await message.answer("❌ JSON-данные токена должны содержать поля 'token' и 'refresh_token'")
+        return
+    
     try:
         # Проверяем, что это валидный JSON
-        token_data = json.loads(token_json)
+        token_data = _json_loads(token_json)
         
-        # Проверяем наличие необходимых полей
-        if 'token' not in token_data or 'refresh_token' not in token_data:
+        # Токен должен быть JSON-объектом: для массива или строки проверка полей ниже тоже прошла бы
+        if not isinstance(token_data, dict) or 'token' not in token_data or 'refresh_token' not in token_data:
             await message.answer("❌ JSON-данные токена должны содержать поля 'token' и 'refresh_token'")
             return        
         
+        # Сохраняем уже разобранный токен: база сериализует его компактно, без пробелов из сообщения
+        await asyncio.to_thread(db.save_token, user_id, token_data)
+        invalidate_events_cache(user_id)
+        # Обновляем USER_ID и сохраняем его в .env, как после других способов авторизации
+        remember_user_id(user_id)
+        # Сразу включаем пользователя в фоновую проверку
+        check_now.set()
+        
         await message.answer("✅ Токен успешно сохранен! Теперь вы можете использовать команды /week и /check.")
+    # orjson.JSONDecodeError - подкласс json.JSONDecodeError
     except json.JSONDecodeError:
         await message.answer("❌ Неверный формат JSON. Пожалуйста, проверьте данные и попробуйте снова.")
     except Exception as e:
-        logging.error(f"Ошибка при установке токена вручную: {e}")
+        logging.error("Ошибка при установке токена вручную: %s", e)
         await message.answer(f"❌ Произошла ошибка: {str(e)}")
 
 # Команда /serverauth для авторизации на сервере
@@ -536,51 +873,23 @@ async def set_token_command(message: Message):
 async def server_auth_command(message: Message):
     user_id = message.from_user.id
     
-    # Создаем URL для авторизации с правильными параметрами
-    auth_url = create_auth_url(user_id, db)
+    # Создаем URL для авторизации с правильными параметрами.
+    # URL содержит новый state при каждом вызове, поэтому не кэшируется
+    auth_url = await asyncio.to_thread(create_auth_url, user_id, db)
     
-    await message.answer(
-        "📱 <b>Инструкция по авторизации на сервере:</b>\n\n"
-        "1️⃣ Перейдите по ссылке ниже в браузере:\n"
-        f"{auth_url}\n\n"
-        "2️⃣ Войдите в аккаунт Google и разрешите доступ к календарю\n\n"
-        "3️⃣ Вы получите код авторизации. Скопируйте его\n\n"
-        "4️⃣ Отправьте боту команду:\n"
-        "/code ПОЛУЧЕННЫЙ_КОД\n\n"
-        "❗ Если возникает ошибка при авторизации, попробуйте использовать команду /manualtoken",
-        parse_mode="HTML"
-    )
+    await message.answer(_SERVER_AUTH_TMPL.format(auth_url=auth_url), parse_mode="HTML")
 
 # Команда /authinfo для получения информации об авторизации
 @dp.message(Command("authinfo"))
 async def auth_info_command(message: Message):
     user_id = message.from_user.id
     
-    # Проверяем наличие credentials.json
-    if not os.path.exists('credentials.json'):
-        await message.answer("❌ Файл credentials.json не найден. Необходимо создать OAuth-клиент в Google Cloud Console.")
-        return
-    
-    # Читаем данные клиента
+    # Читаем данные клиента; отсутствие credentials.json определяется по тому же stat, что и кэш
     try:
-        with open('credentials.json', 'r') as f:
-            client_data = json.load(f)
-        
-        client_info = client_data.get('installed', client_data.get('web', {}))
-        
-        auth_info = (
-            "📋 <b>Информация об OAuth-клиенте:</b>\n\n"
-            f"🔹 Тип клиента: {'Web' if 'web' in client_data else 'Desktop'}\n"
-            f"🔹 Client ID: {client_info.get('client_id', 'Не найден')[:15]}...\n"
-            f"🔹 Redirect URIs: {', '.join(client_info.get('redirect_uris', ['Не найдены']))}\n\n"
-            "Для корректной работы авторизации убедитесь, что:\n"
-            "1. В Google Cloud Console включен Calendar API\n"
-            "2. Настроен OAuth consent screen\n"
-            "3. Добавлен ваш email в список тестовых пользователей\n"
-            "4. В redirect URIs добавлен urn:ietf:wg:oauth:2.0:oob"
-        )
-        
+        auth_info = await asyncio.to_thread(_auth_info, 'credentials.json')
         await message.answer(auth_info, parse_mode="HTML")
+    except FileNotFoundError:
+        await message.answer("❌ Файл credentials.json не найден. Необходимо создать OAuth-клиент в Google Cloud Console.")
     except Exception as e:
         await message.answer(f"❌ Ошибка при чтении данных клиента: {str(e)}")
 
@@ -602,32 +911,50 @@ async def notifications_settings(message: Message):
 
 async def notify_before_meeting(meeting, user_id, minutes_before):
     """Отправляет уведомление за указанное количество минут до начала встречи"""
-    event_id, summary, hangout_link, start_time = meeting
+    event_id, summary, hangout_link, start_time, start_dt, end_time = meeting
     try:
-        start_dt = safe_parse_datetime(start_time)
         now = datetime.now(timezone.utc)
         reminder_time = start_dt - timedelta(minutes=minutes_before)
         
         # Проверяем, нужно ли отправлять уведомление
         if now >= reminder_time and not db.is_event_started(event_id, user_id, minutes_before):
-            await bot.send_message(
+            delivered = await send_queue.send(
                 user_id,
                 f"⏰ Напоминание: встреча {summary} начнется через {minutes_before} минут.\n🔗 {hangout_link}",
                 parse_mode="HTML"
             )
+            if not await delivered:
+                return
             # Помечаем уведомление как отправленное
-            db.add_started_event(event_id, summary, start_time, None, user_id, minutes_before)
-            logging.info(f"Отправлено напоминание пользователю {user_id} о встрече {summary} за {minutes_before} минут")
+            db.add_started_event(event_id, summary, start_time, end_time, user_id, minutes_before)
+            logging.info("Отправлено напоминание пользователю %s о встрече %s за %s минут", user_id, summary, minutes_before)
     except Exception as e:
-        logging.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
+        logging.error("Ошибка при отправке напоминания пользователю %s: %s", user_id, e)
 
 # Запуск бота
 async def main():
-    # Запускаем фоновую задачу для проверки встреч
-    asyncio.create_task(scheduled_meetings_check())
+    # Фоновые задачи именуются, чтобы их было видно в asyncio.all_tasks() и логах
+    background_tasks = [
+        # Отправка сообщений из очереди
+        asyncio.create_task(send_queue.run(), name='send_queue'),
+        # Фоновое сохранение USER_ID в .env
+        asyncio.create_task(env_writer(), name='env_writer'),
+        # Проверка встреч
+        asyncio.create_task(scheduled_meetings_check(), name='meetings_check'),
+    ]
     
-    # Запускаем бота
-    await dp.start_polling(bot)
+    try:
+        # Запускаем бота (long polling: Telegram держит запрос getUpdates до POLLING_TIMEOUT секунд)
+        await dp.start_polling(bot, polling_timeout=int(os.getenv('POLLING_TIMEOUT') or 30), handle_signals=True)
+    finally:
+        # После остановки polling завершаем фоновые задачи, чтобы они не остались висеть
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        db.close()
 
 if __name__ == "__main__":
+    # uvloop (если установлен) заменяет стандартный цикл событий более быстрым на libuv
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main()) 
@@ -2,12 +2,43 @@ import sqlite3
 import json
 import logging
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(data):
+    """Сериализация в JSON-строку (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def _loads(data):
+    """Десериализация JSON-строки (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class Database:
+    # Как долго список пользователей берется из памяти без перечитывания таблицы tokens
+    USERS_CACHE_TTL = 3600
+
     def __init__(self, db_path):
         self.db_path = db_path
+        # Одно соединение на все время работы; запросы приходят из разных потоков (asyncio.to_thread),
+        # поэтому доступ к соединению и к списку пользователей в памяти выполняется по очереди под блокировкой
+        self._conn = None
+        self._lock = threading.RLock()
+        self._users = None
+        self._users_loaded_at = 0.0
         self.init_db()
 
     def init_db(self):
@@ -15,6 +46,10 @@ class Database:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
+            # Журнал WAL: изменения дописываются в конец лога, а не переписывают
+            # страницы базы, сжатие лога выполняется автоматическим checkpoint
+            cursor.execute('PRAGMA journal_mode=WAL')
+            
             # Таблица для хранения токенов и состояний авторизации
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS auth_data (
@@ -110,17 +145,33 @@ class Database:
                     PRIMARY KEY (event_id, user_id)
                 )
             ''')
-            
+
+            # Выборка всех событий пользователя не может использовать первичный ключ (event_id, user_id)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_known_events_user ON known_events (user_id)')
+
             conn.commit()
 
     @contextmanager
     def get_connection(self):
         """Контекстный менеджер для соединения с БД"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                # В режиме WAL достаточно синхронизации на checkpoint, а не на каждый commit
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+            try:
+                yield self._conn
+            except BaseException:
+                # Незавершенная транзакция не должна остаться открытой на общем соединении
+                self._conn.rollback()
+                raise
+
+    def close(self):
+        """Закрывает соединение с БД"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
     def add_started_event(self, event_id, summary, start_time, end_time, user_id, minutes_before):
         """Добавление начатого события с учетом времени уведомления"""
@@ -143,6 +194,18 @@ class Database:
             ''', (event_id, summary, start_time, end_time, str(user_id), 1 if notification_sent else 0))
             conn.commit()
 
+    def add_known_events(self, events, user_id, notification_sent=False):
+        """Добавляет несколько событий одной транзакцией: events - кортежи (event_id, summary, start_time, end_time)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO known_events
+                (event_id, summary, start_time, end_time, user_id, notification_sent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(event_id, summary, start_time, end_time, str(user_id), 1 if notification_sent else 0)
+                  for event_id, summary, start_time, end_time in events])
+            conn.commit()
+
     def is_event_processed(self, event_id):
         """Проверка, было ли событие обработано"""
         with self.get_connection() as conn:
@@ -165,12 +228,18 @@ class Database:
             return cursor.fetchone() is not None
 
     def clean_old_events(self, before_date):
-        """Очистка старых событий"""
+        """Очистка событий, закончившихся до before_date (datetime в UTC)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM processed_events WHERE start_time < ?', (before_date.isoformat(),))
-            cursor.execute('DELETE FROM started_events WHERE end_time < ?', (before_date.isoformat(),))
-            cursor.execute('DELETE FROM known_events WHERE end_time < ?', (before_date.isoformat(),))
+            # end_time хранится в UTC в ISO-формате, поэтому сравнение строк совпадает со сравнением времени.
+            # Встреча удаляется только после окончания: многодневную встречу календарь продолжает
+            # возвращать, и без записи о ней пользователь получил бы уведомление повторно.
+            # Записи прежних версий без end_time здесь не удаляются: для встреч, которые еще есть
+            # в календаре, время окончания дописывает первая проверка после запуска бота
+            cutoff = before_date.isoformat(timespec='seconds')
+            cursor.execute('DELETE FROM started_events WHERE end_time < ?', (cutoff,))
+            cursor.execute('DELETE FROM known_events WHERE end_time < ?', (cutoff,))
             conn.commit()
 
     def save_auth_state(self, user_id, flow_state, redirect_uri):
@@ -179,7 +248,7 @@ class Database:
             cursor = conn.cursor()
             cursor.execute(
                 'INSERT OR REPLACE INTO auth_states (user_id, flow_state, redirect_uri, created_at) VALUES (?, ?, ?, ?)',
-                (str(user_id), json.dumps(flow_state), redirect_uri, datetime.now().isoformat())
+                (str(user_id), _dumps(flow_state), redirect_uri, datetime.now().isoformat())
             )
             conn.commit()
 
@@ -190,7 +259,7 @@ class Database:
             cursor.execute('SELECT flow_state, redirect_uri FROM auth_states WHERE user_id = ?', (str(user_id),))
             result = cursor.fetchone()
             if result:
-                return json.loads(result[0]), result[1]
+                return _loads(result[0]), result[1]
             return None, None
 
     def delete_auth_state(self, user_id):
@@ -218,9 +287,12 @@ class Database:
             cursor.execute('DELETE FROM known_events')
             cursor.execute('DELETE FROM tokens')
             conn.commit()
+        with self._lock:
+            self._users = None
 
     def save_token(self, user_id, token_data):
-        """Сохранение токена пользователя"""
+        """Сохранение токена пользователя (словарь или уже сериализованная JSON-строка)"""
+        token_json = token_data if isinstance(token_data, str) else _dumps(token_data)
         with self.get_connection() as conn:
             cursor = conn.cursor()
             now = datetime.now().isoformat()
@@ -230,9 +302,12 @@ class Database:
                 (user_id, token_data, created_at, updated_at) 
                 VALUES (?, ?, COALESCE((SELECT created_at FROM tokens WHERE user_id = ?), ?), ?)
                 ''',
-                (str(user_id), json.dumps(token_data), str(user_id), now, now)
+                (str(user_id), token_json, str(user_id), now, now)
             )
             conn.commit()
+        with self._lock:
+            if self._users is not None:
+                self._users.add(str(user_id))
 
     def get_token(self, user_id):
         """Получение токена пользователя"""
@@ -241,7 +316,7 @@ class Database:
             cursor.execute('SELECT token_data FROM tokens WHERE user_id = ?', (str(user_id),))
             result = cursor.fetchone()
             if result:
-                return json.loads(result[0])
+                return _loads(result[0])
             return None
 
     def delete_token(self, user_id):
@@ -250,6 +325,9 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM tokens WHERE user_id = ?', (str(user_id),))
             conn.commit()
+        with self._lock:
+            if self._users is not None:
+                self._users.discard(str(user_id))
 
     def save_processed_event(self, event_id, summary, start_time, user_id):
         """Сохранение обработанного события"""
@@ -298,8 +376,18 @@ class Database:
             )
             return cursor.fetchone() is not None
 
-    def get_known_events(self, user_id):
-        """Получение всех известных событий пользователя"""
+    def get_notified_event_ids(self, user_id):
+        """Возвращает множество ID встреч, о которых пользователю уже отправлено уведомление"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT event_id FROM known_events WHERE user_id = ? AND notification_sent = 1',
+                (str(user_id),)
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def get_known_events_map(self, user_id):
+        """Известные события пользователя: {event_id: (summary, start_time, end_time)}"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
@@ -310,16 +398,24 @@ class Database:
                 ''', 
                 (str(user_id),)
             )
-            rows = cursor.fetchall()
-            return [
-                {
-                    'event_id': row[0],
-                    'summary': row[1],
-                    'start_time': row[2],
-                    'end_time': row[3]
-                }
-                for row in rows
-            ]
+            return {row[0]: row[1:] for row in cursor}
+
+    def update_known_events(self, events, deleted_ids, user_id):
+        """Одной транзакцией сохраняет события с отправленным уведомлением и удаляет отмененные.
+        events - кортежи (event_id, summary, start_time, end_time)"""
+        user_id = str(user_id)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO known_events
+                (event_id, summary, start_time, end_time, user_id, notification_sent)
+                VALUES (?, ?, ?, ?, ?, 1)
+            ''', [(event_id, summary, start_time, end_time, user_id) for event_id, summary, start_time, end_time in events])
+            cursor.executemany(
+                'DELETE FROM known_events WHERE event_id = ? AND user_id = ?',
+                [(event_id, user_id) for event_id in deleted_ids]
+            )
+            conn.commit()
 
     def delete_known_event(self, event_id, user_id):
         """Удаление известного события"""
@@ -332,11 +428,15 @@ class Database:
             conn.commit()
 
     def get_all_users(self):
-        """Получение всех пользователей с токенами"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM tokens')
-            return [row[0] for row in cursor.fetchall()] 
+        """Получение всех пользователей с токенами (список хранится в памяти и обновляется при изменении токенов)"""
+        with self._lock:
+            if self._users is None or time.monotonic() - self._users_loaded_at > self.USERS_CACHE_TTL:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT user_id FROM tokens')
+                    self._users = {row[0] for row in cursor.fetchall()}
+                self._users_loaded_at = time.monotonic()
+            return list(self._users)
 
     def is_notification_sent(self, event_id, user_id):
         """Проверяет, было ли отправлено уведомление о встрече"""
@@ -348,5 +448,5 @@ class Database:
             ''', (event_id, str(user_id)))
             result = cursor.fetchone()
             sent = bool(result[0]) if result else False
-            logging.debug(f"is_notification_sent для {event_id}, пользователь {user_id}: {sent}")
+            logging.debug("is_notification_sent для %s, пользователь %s: %s", event_id, user_id, sent)
             return sent 
@@ -1,12 +1,11 @@
 import os
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from dotenv import load_dotenv
-import json
 import uuid
 import logging
 
@@ -22,23 +21,29 @@ TOKEN_DIR = os.getenv("TOKEN_DIR", ".")
 # Убедимся, что директория существует
 os.makedirs(TOKEN_DIR, exist_ok=True)
 
+# Запас на расхождение часов с серверами Google: изменения за это время проверяются повторно
+SYNC_CLOCK_SKEW = timedelta(minutes=1)
+
 async def get_credentials(user_id=None, db=None):
     """Получение и обновление учетных данных Google."""
     creds = None
     
+    loop = asyncio.get_event_loop()
+    
     if user_id:
-        # Получаем токен из базы данных
-        token_data = db.get_token(user_id)
+        # Получаем токен из базы данных (запрос к SQLite выполняем вне цикла событий)
+        token_data = await loop.run_in_executor(None, db.get_token, user_id)
         if token_data:
             creds = Credentials.from_authorized_user_info(token_data, SCOPES)
     
     # Если нет действительных учетных данных, возвращаем None
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            # Обновление токена - сетевой запрос, выполняем его вне цикла событий
+            await loop.run_in_executor(None, lambda: creds.refresh(Request()))
             # Сохраняем обновленные учетные данные
             if user_id and db:
-                db.save_token(user_id, json.loads(creds.to_json()))
+                await loop.run_in_executor(None, db.save_token, user_id, creds.to_json())
         else:
             return None
     
@@ -79,23 +84,24 @@ def create_auth_url(user_id, db):
         
         return auth_url
     except Exception as e:
-        logging.error(f"Ошибка при создании URL авторизации: {e}")
+        logging.error("Ошибка при создании URL авторизации: %s", e)
         return f"Ошибка при создании URL авторизации: {str(e)}"
 
 async def process_auth_code(user_id, code, db):
     """Обрабатывает код авторизации и сохраняет токен."""
+    loop = asyncio.get_event_loop()
     try:
         # Получаем сохраненное состояние
-        flow_state, redirect_uri = db.get_auth_state(user_id)
+        flow_state, redirect_uri = await loop.run_in_executor(None, db.get_auth_state, user_id)
         if not flow_state:
             return False, "Сессия авторизации истекла. Пожалуйста, начните заново с команды /serverauth"
         
-        # Создаем новый flow
-        flow = InstalledAppFlow.from_client_secrets_file(
+        # Создаем новый flow (чтение credentials.json - тоже вне цикла событий)
+        flow = await loop.run_in_executor(None, lambda: InstalledAppFlow.from_client_secrets_file(
             'credentials.json',
             SCOPES,
             redirect_uri=redirect_uri
-        )
+        ))
         
         # Обновляем конфигурацию flow
         flow.client_config.update({
@@ -105,21 +111,43 @@ async def process_auth_code(user_id, code, db):
             'token_uri': flow_state['token_uri']
         })
         
-        # Обмениваем код на токены
-        flow.fetch_token(code=code)
+        # Обмениваем код на токены (сетевой запрос выполняем вне цикла событий)
+        await loop.run_in_executor(None, lambda: flow.fetch_token(code=code))
         creds = flow.credentials
         
-        # Сохраняем учетные данные
-        db.save_token(user_id, json.loads(creds.to_json()))
-        
-        # Удаляем состояние авторизации из базы данных
-        db.delete_auth_state(user_id)
+        # Сохраняем учетные данные и удаляем состояние авторизации из базы данных
+        await loop.run_in_executor(None, db.save_token, user_id, creds.to_json())
+        await loop.run_in_executor(None, db.delete_auth_state, user_id)
         
         return True, "✅ Авторизация успешно завершена! Теперь вы можете использовать команды бота."
     except Exception as e:
-        logging.error(f"Ошибка при обработке кода авторизации: {e}")
+        logging.error("Ошибка при обработке кода авторизации: %s", e)
         return False, f"❌ Ошибка при обработке кода авторизации: {str(e)}"
 
+def _has_changes(service, since):
+    """Проверяет, менялись ли события календаря (включая удаленные) после момента since."""
+    result = service.events().list(
+        calendarId='primary',
+        updatedMin=(since - SYNC_CLOCK_SKEW).isoformat(),
+        maxResults=1,
+        fields='items(id),nextPageToken'
+    ).execute()
+    # Страница может оказаться пустой, даже если изменения есть: тогда в ответе будет nextPageToken
+    return bool(result.get('items') or result.get('nextPageToken'))
+
+async def has_calendar_changes(user_id, db, since):
+    """Проверяет, менялся ли календарь пользователя после момента since (datetime в UTC)."""
+    loop = asyncio.get_event_loop()
+    
+    creds = await get_credentials(user_id, db)
+    # Без учетных данных сравнивать не с чем: пусть вызывающий код запросит события заново
+    if not creds:
+        return True
+    
+    service = await loop.run_in_executor(
+        None, lambda: build('calendar', 'v3', credentials=creds))
+    return await loop.run_in_executor(None, _has_changes, service, since)
+
 async def get_upcoming_events(limit=10, time_min=None, time_max=None, user_id=None, db=None):
     """Получение предстоящих событий из Google Calendar."""
     loop = asyncio.get_event_loop()
@@ -138,7 +166,8 @@ async def get_upcoming_events(limit=10, time_min=None, time_max=None, user_id=No
     # Устанавливаем временные рамки, если не указаны
     if time_min is None:
         # Используем начало текущего дня в UTC
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        # Время без часового пояса: ниже к строке добавляется суффикс 'Z'
+        today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
         time_min = today
     if time_max is None:
         # Используем конец дня через 7 дней
@@ -148,7 +177,7 @@ async def get_upcoming_events(limit=10, time_min=None, time_max=None, user_id=No
     time_min_str = time_min.isoformat() + 'Z'
     time_max_str = time_max.isoformat() + 'Z'
     
-    logging.info(f"Запрашиваем события с {time_min_str} по {time_max_str}")
+    logging.info("Запрашиваем события с %s по %s", time_min_str, time_max_str)
     
     # Вызываем API
     events_result = await loop.run_in_executor(
@@ -166,13 +195,14 @@ async def get_upcoming_events(limit=10, time_min=None, time_max=None, user_id=No
     events = events_result.get('items', [])
     
     # Логируем количество полученных событий
-    logging.info(f"Получено {len(events)} событий из календаря")
+    logging.info("Получено %d событий из календаря", len(events))
     
     # Логируем первые несколько событий для отладки
     for i, event in enumerate(events[:3]):
-        start_time = event['start'].get('dateTime', event['start'].get('date'))
+        start = event['start']
+        start_time = start.get('dateTime') or start.get('date')
         summary = event.get('summary', 'Без названия')
-        logging.info(f"Событие {i+1}: {summary} в {start_time}")
+        logging.info("Событие %d: %s в %s", i + 1, summary, start_time)
     
     # Возвращаем все события, а не только с Google Meet
     return events
@@ -181,9 +211,12 @@ async def get_credentials_with_local_server():
     """Получение учетных данных с использованием локального сервера."""
     try:
         flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-        creds = flow.run_local_server(port=0)
+        # Сервер ждет, пока пользователь завершит авторизацию в браузере, поэтому
+        # запускаем его в отдельном потоке, чтобы бот продолжал обрабатывать сообщения
+        loop = asyncio.get_event_loop()
+        creds = await loop.run_in_executor(None, lambda: flow.run_local_server(port=0))
         logging.info("Успешно получены учетные данные через локальный сервер")
         return creds
     except Exception as e:
-        logging.error(f"Ошибка при получении учетных данных через локальный сервер: {e}")
+        logging.error("Ошибка при получении учетных данных через локальный сервер: %s", e)
         return None 
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не более capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def hit(self):
+        """Забирает токен, если он есть. Возвращает время ожидания следующего токена"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self):
+        """Проверяет, восстановился ли запас токенов полностью"""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        """Ожидает, пока не появится свободный токен"""
+        while True:
+            delay = self.hit()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с соблюдением лимитов Telegram API"""
+
+    # Сколько ограничителей чатов хранится, прежде чем удалить неиспользуемые
+    CHAT_LIMITS_MAX = 1024
+
+    def __init__(self, bot, workers=4, maxsize=50, global_rate=25, chat_rate=1, chat_burst=3):
+        self.bot = bot
+        # Сообщения одного чата всегда попадают в одну очередь, поэтому сохраняют порядок,
+        # а отправки в разные чаты выполняются параллельно.
+        # Очереди ограничены: если Telegram не успевает, send ждет, а не копит сообщения в памяти
+        self.queues = [asyncio.Queue(maxsize=maxsize) for _ in range(workers)]
+        # Общий лимит бота (~30 сообщений в секунду) и лимит на один чат (~1 в секунду)
+        self.global_limit = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_limits = {}
+
+    async def send(self, chat_id, text, parse_mode=None):
+        """Ставит сообщение в очередь; возвращает future, которое получит True после доставки или False при ошибке"""
+        # ID чата приходит и числом (из сообщений), и строкой (из базы)
+        queue = self.queues[hash(str(chat_id)) % len(self.queues)]
+        delivered = asyncio.get_running_loop().create_future()
+        await queue.put((chat_id, text, parse_mode, delivered))
+        return delivered
+
+    async def run(self):
+        """Отправляет сообщения из очередей, пока задача не будет отменена"""
+        try:
+            await asyncio.gather(*(self._worker(queue) for queue in self.queues))
+        finally:
+            # Сообщения, оставшиеся в очереди при остановке, не доставлены:
+            # ожидающие подтверждения получают отмену, а не True
+            for queue in self.queues:
+                while not queue.empty():
+                    queue.get_nowait()[3].cancel()
+
+    async def _worker(self, queue):
+        """Последовательно отправляет сообщения из одной очереди"""
+        while True:
+            chat_id, text, parse_mode, delivered = await queue.get()
+            try:
+                await self._deliver(chat_id, text, parse_mode)
+                result = True
+            except asyncio.CancelledError:
+                delivered.cancel()
+                raise
+            except Exception as e:
+                logging.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e)
+                result = False
+            finally:
+                queue.task_done()
+            # Ожидающий результат мог быть уже отменен
+            if not delivered.done():
+                delivered.set_result(result)
+
+    def _chat_limit(self, chat_id):
+        """Возвращает ограничитель для чата, создавая его при первом обращении"""
+        key = str(chat_id)
+        bucket = self.chat_limits.get(key)
+        if bucket is None:
+            if len(self.chat_limits) >= self.CHAT_LIMITS_MAX:
+                # Полностью восстановленный ограничитель ничем не отличается от нового, его можно удалить
+                self.chat_limits = {k: b for k, b in self.chat_limits.items() if not b.is_full()}
+            bucket = self.chat_limits[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _deliver(self, chat_id, text, parse_mode):
+        """Отправляет одно сообщение, дожидаясь лимитов и повторяя при RetryAfter"""
+        await self._chat_limit(chat_id).acquire()
+        while True:
+            await self.global_limit.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode=parse_mode)
+                return
+            except TelegramRetryAfter as e:
+                logging.warning("Превышен лимит Telegram для чата %s, повтор через %s с", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)